@@ -20,16 +20,21 @@ import importlib
 import logging
 import sys
 
-from collections import defaultdict
-
 from koschei.config import get_config
 
-listeners = defaultdict(list)
+# event name -> listeners, dict is used as an insertion-ordered set
+listeners = {}
+
+# (plugin name, endpoint) pairs that were already processed, including endpoints
+# that the plugin doesn't provide, so that failed lookups aren't repeated
+_loaded = set()
 
 
 def load_plugins(endpoint, only=None):
     log = logging.getLogger('koschei.plugin')
     for name in only if only is not None else get_config('plugins'):
+        if (name, endpoint) in _loaded:
+            continue
         qualname = f'koschei.plugins.{name}_plugin'
         if qualname not in sys.modules:
             log.debug('Loading %s plugin', name)
@@ -43,19 +48,18 @@ def load_plugins(endpoint, only=None):
                 importlib.import_module(qualname)
             except ImportError:
                 # plugin exists but doesn't have particular endpoint
-                continue
+                pass
+        _loaded.add((name, endpoint))
 
 
 def listen_event(name):
     def decorator(fn):
-        if fn not in listeners[name]:
-            listeners[name].append(fn)
+        listeners.setdefault(name, {}).setdefault(fn, None)
         return fn
     return decorator
 
 
 def dispatch_event(name, *args, **kwargs):
-    result = []
-    for listener in listeners[name]:
-        result.append(listener(*args, **kwargs))
-    return result
+    # don't use item access, so that dispatching an event nobody listens to
+    # doesn't create new entries
+    return [listener(*args, **kwargs) for listener in listeners.get(name, ())]
@@ -18,32 +18,39 @@
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
 import os
+import re
+import hashlib
 import sys
 import unittest
 import shutil
 import json
-import psycopg2
+import tempfile
 import rpm
 import vcr
 import contextlib
 
 from mock import Mock, patch
 from datetime import datetime
-from functools import wraps
+from functools import lru_cache, wraps
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.sql import insert
 
 from test import testdir, config, koji_vcr
 from koschei import plugin
 from koschei.config import get_config
-from koschei.db import get_engine, create_all, Base, get_or_create
+from koschei.db import get_engine, create_all, Base
 from koschei.models import (
     Package, Build, Collection, BasePackage,
     PackageGroupRelation, PackageGroup, GroupACL, User,
     KojiTask, Dependency, AppliedChange, LogEntry,
     ResolutionChange, ResolutionProblem
 )
-from koschei.backend import KoscheiBackendSession, repo_util, service, koji_util
+from koschei.backend import KoscheiBackendSession, service, koji_util
 
-workdir = '.workdir'
+# [epoch:]name-version-release
+NEVR_RE = re.compile(r'^(?:([^:]*):)?(.+)-([^-]+)-([^-]+)$')
 
 my_vcr = vcr.VCR(
     cassette_library_dir=os.path.join(testdir, 'data'),
@@ -52,6 +59,33 @@ my_vcr = vcr.VCR(
 )
 
 
+@lru_cache(maxsize=None)
+def _load_json_data(name):
+    with open(os.path.join(testdir, 'data', name)) as fo:
+        return json.load(fo)
+
+
+# logged-in primary Koji sessions, keyed by server URL
+_logged_in_koji_sessions = {}
+
+
+def _primary_koji_session(anonymous):
+    """
+    Returns a primary Koji session for currently configured server. Logging in is
+    expensive, so logged-in sessions are reused as long as the configuration they
+    were created from is still the current one. Anonymous sessions are cheap to
+    create and are not shared between tests.
+    """
+    if anonymous:
+        return koji_util.KojiSession('primary', anonymous=True)
+    config = get_config('koji_config')
+    session = _logged_in_koji_sessions.get(config['server'])
+    if session is None or session.config is not config:
+        session = koji_util.KojiSession('primary', anonymous=False)
+        _logged_in_koji_sessions[config['server']] = session
+    return session
+
+
 class DummyKoji(object):
     """
     Dummy Koji Session for tests that don't need to access Koji, but still need a session.
@@ -83,25 +117,23 @@ class AbstractTest(unittest.TestCase):
         """
         return DummyKoji(koji_id)
 
-    def _rm_workdir(self):
-        try:
-            shutil.rmtree(workdir)
-        except OSError:
-            pass
-
     def setUp(self):
-        self._rm_workdir()
-        os.mkdir(workdir)
-        os.chdir(workdir)
-
-    def tearDown(self):
-        os.chdir(testdir)
-        self._rm_workdir()
+        # Test config uses paths relative to working directory, so it needs to be
+        # a direct subdirectory of testdir. A unique directory is created for each
+        # test, so there's no need to clean up leftovers of previous runs.
+        self.workdir = tempfile.mkdtemp(prefix='.workdir-', dir=testdir)
+        # Cleanups run in reverse order, even if setUp of a subclass fails or skips
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.addCleanup(os.chdir, testdir)
+        os.chdir(self.workdir)
 
     @staticmethod
     def get_json_data(name):
-        with open(os.path.join(testdir, 'data', name)) as fo:
-            return json.load(fo)
+        """
+        Returns parsed contents of JSON file from test data directory. Files are
+        parsed only once, the returned object is shared and must not be modified.
+        """
+        return _load_json_data(name)
 
     @contextlib.contextmanager
     def koji_cassette(self, *cassettes, secondary_mode=False):
@@ -142,7 +174,7 @@ class AbstractTest(unittest.TestCase):
 
         with patch_config('koji_config.server', koji_url):
             with patch_config('secondary_koji_config.server', secondary_koji_url):
-                primary_koji = koji_util.KojiSession('primary', anonymous=not logged_in)
+                primary_koji = _primary_koji_session(anonymous=not logged_in)
                 primary_vcr = koji_vcr.KojiVCR(primary_koji, cassettes)
                 primary_mock = primary_vcr.create_mock()
                 if secondary_mode:
@@ -206,21 +238,66 @@ class DBTest(AbstractTest):
         'debug_print_plan': 'on',
     }
     postgres_initialized = None
+    truncate_sql = None
+    BUILD_STATES = {
+        True: Build.COMPLETE,
+        False: Build.FAILED,
+        None: Build.RUNNING,
+        'complete': Build.COMPLETE,
+        'failed': Build.FAILED,
+        'running': Build.RUNNING,
+    }
+    # connection used for cleaning up the database, shared by tests of a class
+    conn = None
+
+    @staticmethod
+    def schema_hash():
+        """
+        Returns a hash of everything that determines the contents of a freshly
+        initialized test database - table and index DDL, materialized view queries,
+        DDL scripts and database options.
+        """
+        dialect = postgresql.dialect()
+        schema = hashlib.sha1()
+        for table in sorted(Base.metadata.tables.values(), key=lambda t: t.name):
+            schema.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+            for index in sorted(table.indexes, key=lambda i: i.name or ''):
+                schema.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+            if table.materialized_view:
+                schema.update(str(table.materialized_view._view_sql).encode())
+        datadir = get_config('directories.datadir')
+        for script in ('triggers.sql', 'rpmvercmp.sql'):
+            with open(os.path.join(datadir, script), 'rb') as fo:
+                schema.update(fo.read())
+        schema.update(repr(sorted(DBTest.POSTGRES_OPTS.items())).encode())
+        return schema.hexdigest()
 
     @staticmethod
     def init_postgres():
-        print("Initializing test database...", file=sys.stderr)
+        import psycopg2
         dbname = config['database_config']['database']
-        with psycopg2.connect(dbname='postgres') as conn:
+        schema_hash = DBTest.schema_hash()
+        with contextlib.closing(psycopg2.connect(dbname='postgres')) as conn:
             conn.autocommit = True
             with conn.cursor() as cur:
+                # The schema hash is stored as a comment on the database once it's
+                # fully initialized. If it matches, the database from previous run
+                # can be reused, setUp clears all data anyway.
+                cur.execute("SELECT shobj_description(oid, 'pg_database') "
+                            "FROM pg_database WHERE datname = %s", (dbname,))
+                row = cur.fetchone()
+                if row and row[0] == schema_hash:
+                    return
+                print("Initializing test database...", file=sys.stderr)
                 cur.execute("DROP DATABASE IF EXISTS {0}".format(dbname))
                 cur.execute("CREATE DATABASE {0}".format(dbname))
                 for option, value in DBTest.POSTGRES_OPTS.items():
                     cur.execute("ALTER DATABASE {0} SET {1} TO '{2}'".format(dbname,
                                                                              option,
                                                                              value))
-        create_all()
+                create_all()
+                cur.execute("COMMENT ON DATABASE {0} IS %s".format(dbname),
+                            (schema_hash,))
 
     def __init__(self, *args, **kwargs):
         super(DBTest, self).__init__(*args, **kwargs)
@@ -243,19 +320,31 @@ class DBTest(AbstractTest):
             if not os.environ.get('TEST_WITHOUT_POSTGRES'):
                 DBTest.init_postgres()
                 DBTest.postgres_initialized = True
+        if DBTest.postgres_initialized:
+            cls.conn = get_engine().connect()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.conn is not None:
+            cls.conn.close()
+            cls.conn = None
+        super(DBTest, cls).tearDownClass()
 
     def setUp(self):
         super(DBTest, self).setUp()
         if not DBTest.postgres_initialized:
             self.skipTest("requires PostgreSQL")
-        conn = get_engine().connect()
-        for table in Base.metadata.non_materialized_view_tables:
-            conn.execute(table.delete())
-            if hasattr(table.c, 'id'):
-                conn.execute("ALTER SEQUENCE {}_id_seq RESTART".format(table.name))
-        for materialized_view in Base.metadata.materialized_views:
-            materialized_view.refresh(conn)
-        conn.close()
+        conn = self.conn
+        if DBTest.truncate_sql is None:
+            preparer = conn.dialect.identifier_preparer
+            DBTest.truncate_sql = "TRUNCATE TABLE {} RESTART IDENTITY CASCADE".format(
+                ', '.join(preparer.format_table(table)
+                          for table in Base.metadata.non_materialized_view_tables)
+            )
+        with conn.begin():
+            conn.execute(DBTest.truncate_sql)
+            for materialized_view in Base.metadata.materialized_views:
+                materialized_view.refresh(conn)
         self.session = self.create_session()
         self.db = self.session.db
         self.db.add(self.collection)
@@ -308,14 +397,23 @@ class DBTest(AbstractTest):
         return pkg
 
     def prepare_packages(self, *pkg_names):
-        pkgs = []
-        for name in pkg_names:
-            pkg = self.db.query(Package).filter_by(name=name).first()
-            if not pkg:
-                pkg = self.prepare_package(name)
-            pkgs.append(pkg)
+        pkgs = {}
+        if pkg_names:
+            for pkg in self.db.query(Package).filter(Package.name.in_(pkg_names)):
+                pkgs.setdefault(pkg.name, pkg)
+        missing = [name for name in dict.fromkeys(pkg_names) if name not in pkgs]
+        if missing:
+            bases = {
+                base.name: base for base in
+                self.db.query(BasePackage).filter(BasePackage.name.in_(missing))
+            }
+            for name in missing:
+                base = bases.get(name) or BasePackage(name=name)
+                pkgs[name] = Package(name=name, base=base, collection=self.collection,
+                                     tracked=True)
+                self.db.add(pkgs[name])
         self.db.commit()
-        return pkgs
+        return [pkgs[name] for name in pkg_names]
 
     def prepare_task(self, build, state=1, arch='x86_64', started=None, task_id=None):
         if not task_id:
@@ -335,16 +433,8 @@ class DBTest(AbstractTest):
     def prepare_build(self, package, state=None, repo_id=None, resolved=True,
                       arches=(), task_id=None, started=None, untagged=False,
                       epoch=None, version='1', release='1.fc25', real=False):
-        states = {
-            True: Build.COMPLETE,
-            False: Build.FAILED,
-            None: Build.RUNNING,
-            'complete': Build.COMPLETE,
-            'failed': Build.FAILED,
-            'running': Build.RUNNING,
-        }
         if isinstance(state, (bool, str)):
-            state = states[state]
+            state = self.BUILD_STATES[state]
         if isinstance(package, str):
             found = self.db.query(Package).\
                 filter_by(name=package, collection_id=self.collection.id).first()
@@ -359,14 +449,15 @@ class DBTest(AbstractTest):
         if not task_id:
             self.task_id_counter += 1
         self.db.add(build)
-        self.db.commit()
-        for arch in arches:
-            koji_task = KojiTask(task_id=7541,
-                                 arch=arch,
-                                 state=1,
-                                 started=datetime.fromtimestamp(123),
-                                 build_id=build.id)
-            self.db.add(koji_task)
+        self.db.flush()
+        if arches:
+            self.db.execute(KojiTask.__table__.insert(),
+                            [dict(task_id=7541,
+                                  arch=arch,
+                                  state=1,
+                                  started=datetime.fromtimestamp(123),
+                                  build_id=build.id)
+                             for arch in arches])
         self.db.commit()
         return build
 
@@ -396,24 +487,41 @@ class DBTest(AbstractTest):
 
     def prepare_depchange(self, dep_name, prev_epoch, prev_version, prev_release,
                           curr_epoch, curr_version, curr_release, build_id, distance):
-        prev_dep = get_or_create(
-            self.db,
-            Dependency,
-            name=dep_name,
-            epoch=prev_epoch, version=prev_version, release=prev_release,
-            arch='x86_64',
-        )
-        curr_dep = get_or_create(
-            self.db,
-            Dependency,
-            name=dep_name,
-            epoch=curr_epoch, version=curr_version, release=curr_release,
-            arch='x86_64',
-        )
-        self.db.flush()
+        # Keys are compared with values returned from the database, where epoch is
+        # an integer, but callers may pass it as a string (see parse_pkg)
+        prev_epoch = int(prev_epoch) if prev_epoch is not None else None
+        curr_epoch = int(curr_epoch) if curr_epoch is not None else None
+        prev_nevra = (dep_name, prev_epoch, prev_version, prev_release, 'x86_64')
+        curr_nevra = (dep_name, curr_epoch, curr_version, curr_release, 'x86_64')
+        # Epoch may be NULL and the unique index doesn't consider NULLs equal, so
+        # ON CONFLICT cannot be used. Query both and insert the missing ones instead.
+        nevra_filter = or_(*(
+            and_(
+                Dependency.name == nevra[0],
+                Dependency.epoch == nevra[1],
+                Dependency.version == nevra[2],
+                Dependency.release == nevra[3],
+                Dependency.arch == nevra[4],
+            )
+            for nevra in (prev_nevra, curr_nevra)
+        ))
+        dep_ids = {
+            tuple(dep)[1:]: dep.id
+            for dep in self.db.query(*Dependency.inevra).filter(nevra_filter)
+        }
+        missing = {prev_nevra, curr_nevra} - dep_ids.keys()
+        if missing:
+            columns = [column.name for column in Dependency.nevra]
+            inserted = self.db.execute(insert(
+                Dependency,
+                [dict(zip(columns, nevra)) for nevra in missing],
+                returning=Dependency.inevra,
+            ))
+            for dep in inserted:
+                dep_ids[tuple(dep)[1:]] = dep.id
         change = AppliedChange(
-            prev_dep_id=prev_dep.id,
-            curr_dep_id=curr_dep.id,
+            prev_dep_id=dep_ids[prev_nevra],
+            curr_dep_id=dep_ids[curr_nevra],
             distance=distance,
             build_id=build_id,
         )
@@ -437,10 +545,7 @@ class DBTest(AbstractTest):
 
     @staticmethod
     def parse_pkg(string):
-        epoch = None
-        if ':' in string:
-            epoch, _, string = string.partition(':')
-        name, version, release = string.rsplit('-', 2)
+        epoch, name, version, release = NEVR_RE.match(string).groups()
         return dict(epoch=epoch, name=name, version=version, release=release,
                     arch='x86_64')
 
@@ -449,10 +554,18 @@ class DBTest(AbstractTest):
         self.assertCountEqual(messages, logs)
 
 
+@lru_cache(maxsize=None)
+def _split_config_key(key):
+    *parts, last = key.split('.')
+    return tuple(parts), last
+
+
 @contextlib.contextmanager
 def patch_config(key, value):
+    # Only the key splitting is cached, the dicts are looked up every time,
+    # because a patched parent key replaces the nested dict
+    parts, last = _split_config_key(key)
     config_dict = get_config(None)
-    *parts, last = key.split('.')
     for part in parts:
         config_dict = config_dict[part]
 
@@ -499,6 +612,7 @@ def with_koji_cassette(*cassettes):
 class RepoCacheMock(object):
     @contextlib.contextmanager
     def get_sack(self, desc):
+        from koschei.backend import repo_util
         if 123 < desc.repo_id < 130:
             desc = koji_util.KojiRepoDescriptor(desc.koji_id, desc.build_tag, 123)
         yield repo_util.load_sack(os.path.join(testdir, 'repos'), desc)
@@ -16,6 +16,8 @@
 #
 # Author: Mikolaj Izdebski <mizdebsk@redhat.com>
 
+from mock import patch
+
 from koschei.plugin import load_plugins
 
 from test.common import AbstractTest
@@ -35,3 +37,9 @@ class PluginTest(AbstractTest):
     def test_load_plugin_different_endpoints(self):
         load_plugins('backend', ['pagure'])
         load_plugins('frontend', ['pagure'])
+
+    def test_load_plugin_cached(self):
+        load_plugins('xyzzy', ['pagure'])
+        with patch('importlib.import_module') as import_module:
+            load_plugins('xyzzy', ['pagure'])
+            import_module.assert_not_called()